@@ -1,9 +1,19 @@
+import gc
+import os
 import re
+import sys
+import gzip
+import json
+import keyword
 import math
+import time
+import pickle
 import random
+import argparse
+import tracemalloc
 
-# Combined lexer and parser for efficiency
-def parse_code(code):
+# Lexer - convert source text to (kind, value) tokens
+def tokenize(code):
     # Token patterns
     patterns = {
         'STRING': r'"[^"]*"',
@@ -15,6 +25,9 @@ def parse_code(code):
         'RPAREN': r'\)',
         'LBRACKET': r'\[',
         'RBRACKET': r'\]',
+        'LBRACE': r'\{',
+        'RBRACE': r'\}',
+        'COLON': r':',
         'COMMA': r',',
         'SEMICOLON': r';',
         'SKIP': r'[ \t\n]+',
@@ -28,7 +41,6 @@ def parse_code(code):
         'try', 'catch', 'import', 'class', 'attributes', 'methods'
     }
     
-    # Lexer - convert to tokens
     regex = '|'.join(f'(?P<{name}>{pattern})' for name, pattern in patterns.items())
     tokens = []
     
@@ -43,59 +55,105 @@ def parse_code(code):
         else:
             tokens.append((kind, value))
     
-    # Parse AST
-    ast = []
-    i = 0
+    return tokens
+
+# Parser: build the AST from source code
+def parse_code(code):
+    tokens = tokenize(code)
+    ast, _ = parse_block(tokens, 0)
+    return ast
+
+# Collect one expression: operands joined by operators, with parenthesized
+# groups kept whole. Returns the expression text and the next token index
+def parse_expression(tokens, i):
+    parts = []
+    depth = 0
+    expect_operand = True
     
-    # Helper to get variable value
-    def get_value(val, vars):
-        if isinstance(val, (int, float, bool, list)):
-            return val
-        elif val in vars:
-            return vars[val]
-        elif val.replace('.', '', 1).isdigit():
-            return float(val) if '.' in val else int(val)
-        elif val.lower() in ('true', 'false'):
-            return val.lower() == 'true'
-        elif val.startswith('"') and val.endswith('"'):
-            return val.strip('"')
+    while i < len(tokens):
+        kind, value = tokens[i]
+        
+        if depth > 0:
+            if kind == 'LPAREN':
+                depth += 1
+            elif kind == 'RPAREN':
+                depth -= 1
+                if depth == 0:
+                    expect_operand = False
+        elif expect_operand:
+            if kind == 'LPAREN':
+                depth = 1
+            elif kind == 'IDENTIFIER' and value == 'not':
+                pass
+            elif kind == 'OPERATOR' and value == '-':
+                pass
+            elif kind in ('NUMBER', 'STRING', 'BOOLEAN', 'IDENTIFIER'):
+                expect_operand = False
+            else:
+                break
+        elif (kind == 'OPERATOR' and value != '=') or (kind == 'IDENTIFIER' and value in ('and', 'or')):
+            expect_operand = True
         else:
-            # Try evaluating as expression
-            try:
-                return eval_expr(val, vars)
-            except:
-                return val
-    
-    # Evaluate expressions with variables
-    def eval_expr(expr, vars):
-        # Replace variables with their values
-        for name, val in vars.items():
-            if not isinstance(val, list):
-                pattern = r'\b' + re.escape(name) + r'\b'
-                expr = re.sub(pattern, str(val).lower() if isinstance(val, bool) else str(val), expr)
-        
-        # Replace logical operators for Python evaluation
-        expr = expr.replace('and', ' and ').replace('or', ' or ').replace('not', ' not ')
+            break
         
-        try:
-            return eval(expr)
-        except:
-            return expr
+        parts.append(value)
+        i += 1
     
-    # Parse statements
-    while i < len(tokens):
-        if i >= len(tokens):
-            break
+    return ' '.join(parts), i
+
+# True if tokens[i] is the given word. 'checkpoint', 'map', 'from' and 'step'
+# are only special in their own statements, so they stay usable as names
+def is_word(tokens, i, word):
+    return i < len(tokens) and tokens[i] == ('IDENTIFIER', word)
+
+# Skip ahead to a keyword token such as THEN or DO and past it
+def skip_past(tokens, i, token_type):
+    while i < len(tokens) and tokens[i][0] != token_type:
+        i += 1
+    
+    if i < len(tokens):
+        i += 1
+    return i
+
+# Parse 'name(arg, ...)' after 'call'; returns the call node and next index
+def parse_call(tokens, i):
+    func_name = tokens[i][1]
+    i += 1
+    
+    # Parse arguments
+    args = []
+    if i < len(tokens) and tokens[i][0] == 'LPAREN':
+        i += 1
+        
+        while i < len(tokens) and tokens[i][0] != 'RPAREN':
+            arg, next_i = parse_expression(tokens, i)
+            if next_i == i:
+                i += 1
+                continue
             
+            args.append(arg)
+            i = next_i
+            if i < len(tokens) and tokens[i][0] == 'COMMA':
+                i += 1
+        
+        i += 1  # Skip )
+    
+    return {"type": "Call", "function": func_name, "arguments": args}, i
+
+# Parse statements until one of the stop tokens (or the end of input).
+# Returns the statements and the index of the stop token
+def parse_block(tokens, i, stop=()):
+    ast = []
+    
+    while i < len(tokens) and tokens[i][0] not in stop:
         token_type, token_value = tokens[i]
         
         # Print statement
         if token_type == 'PRINT':
             i += 1
             if i < len(tokens):
-                expr = tokens[i][1]
+                expr, i = parse_expression(tokens, i)
                 ast.append({"type": "Print", "value": expr})
-                i += 1
         
         # Input statement
         elif token_type == 'INPUT':
@@ -139,60 +197,63 @@ def parse_code(code):
                     ast.append({"type": "AssignArray", "name": name, "elements": elements})
                 else:
                     raise SyntaxError("Expected ']' to close array")
+            
+            # Map assignment
+            elif is_word(tokens, i, 'map') and i + 1 < len(tokens) and tokens[i+1][0] == 'LBRACE':
+                i += 1
+                if i >= len(tokens) or tokens[i][0] != 'LBRACE':
+                    raise SyntaxError("Expected '{' after 'map'")
+                i += 1
+                
+                entries = []
+                while i < len(tokens) and tokens[i][0] != 'RBRACE':
+                    key, i = parse_expression(tokens, i)
+                    if i >= len(tokens) or tokens[i][0] != 'COLON':
+                        raise SyntaxError("Expected ':' after map key")
+                    value, i = parse_expression(tokens, i + 1)
+                    entries.append([key, value])
+                    if i < len(tokens) and tokens[i][0] == 'COMMA':
+                        i += 1
+                
+                if i < len(tokens) and tokens[i][0] == 'RBRACE':
+                    i += 1
+                    ast.append({"type": "AssignMap", "name": name, "entries": entries})
+                else:
+                    raise SyntaxError("Expected '}' to close map")
+            
+            # Assignment from a function call
+            elif i + 1 < len(tokens) and tokens[i][0] == 'CALL':
+                call, i = parse_call(tokens, i + 1)
+                ast.append({
+                    "type": "AssignCall",
+                    "name": name,
+                    "function": call["function"],
+                    "arguments": call["arguments"]
+                })
             else:
                 # Regular assignment
-                expr = tokens[i][1]
-                i += 1
+                expr, i = parse_expression(tokens, i)
                 ast.append({"type": "Assign", "name": name, "value": expr})
         
         # If statement
         elif token_type == 'IF':
-            i += 1
-            condition = tokens[i][1]
-            i += 1
-            
-            # Find then
-            while i < len(tokens) and tokens[i][0] != 'THEN':
-                i += 1
-            
-            if i < len(tokens):
-                i += 1  # Skip then
+            condition, i = parse_expression(tokens, i + 1)
+            i = skip_past(tokens, i, 'THEN')
             
             # Parse if body
-            if_body = []
+            if_body, i = parse_block(tokens, i, ('ELSE', 'ELIF', 'END'))
             elif_clauses = []
             else_body = []
-            current_body = if_body
             
-            while i < len(tokens) and tokens[i][0] != 'END':
-                if tokens[i][0] == 'ELSE':
-                    i += 1
-                    current_body = else_body
-                    continue
-                elif tokens[i][0] == 'ELIF':
-                    i += 1
-                    elif_cond = tokens[i][1]
-                    i += 1
-                    
-                    # Find then
-                    while i < len(tokens) and tokens[i][0] != 'THEN':
-                        i += 1
-                        
-                    if i < len(tokens):
-                        i += 1  # Skip then
-                    
-                    elif_body = []
-                    elif_clauses.append({"condition": elif_cond, "body": elif_body})
-                    current_body = elif_body
-                    continue
+            while i < len(tokens) and tokens[i][0] == 'ELIF':
+                elif_cond, i = parse_expression(tokens, i + 1)
+                i = skip_past(tokens, i, 'THEN')
                 
-                # Parse statement
-                stmt_ast = parse_statement(tokens[i:])
-                if stmt_ast:
-                    current_body.append(stmt_ast)
-                    i += 1
-                else:
-                    i += 1
+                elif_body, i = parse_block(tokens, i, ('ELSE', 'ELIF', 'END'))
+                elif_clauses.append({"condition": elif_cond, "body": elif_body})
+            
+            if i < len(tokens) and tokens[i][0] == 'ELSE':
+                else_body, i = parse_block(tokens, i + 1, ('END',))
             
             if i < len(tokens) and tokens[i][0] == 'END':
                 i += 1
@@ -207,24 +268,11 @@ def parse_code(code):
         
         # While loop
         elif token_type == 'WHILE':
-            i += 1
-            condition = tokens[i][1]
-            i += 1
-            
-            # Find do
-            while i < len(tokens) and tokens[i][0] != 'DO':
-                i += 1
-            
-            if i < len(tokens):
-                i += 1  # Skip do
+            condition, i = parse_expression(tokens, i + 1)
+            i = skip_past(tokens, i, 'DO')
             
             # Parse while body
-            body = []
-            while i < len(tokens) and tokens[i][0] != 'END':
-                stmt_ast = parse_statement(tokens[i:])
-                if stmt_ast:
-                    body.append(stmt_ast)
-                i += 1
+            body, i = parse_block(tokens, i, ('END',))
             
             if i < len(tokens) and tokens[i][0] == 'END':
                 i += 1
@@ -237,31 +285,23 @@ def parse_code(code):
         
         # Repeat loop
         elif token_type == 'REPEAT':
-            i += 1
-            if i < len(tokens) and tokens[i][0] == 'NUMBER':
-                count = int(float(tokens[i][1]))
+            count, i = parse_expression(tokens, i + 1)
+            
+            # Find times
+            if i < len(tokens) and tokens[i][0] == 'TIMES':
                 i += 1
-                
-                # Find times
-                if i < len(tokens) and tokens[i][0] == 'TIMES':
-                    i += 1
-                
-                # Parse repeat body
-                body = []
-                while i < len(tokens) and tokens[i][0] != 'END':
-                    stmt_ast = parse_statement(tokens[i:])
-                    if stmt_ast:
-                        body.append(stmt_ast)
-                    i += 1
-                
-                if i < len(tokens) and tokens[i][0] == 'END':
-                    i += 1
-                
-                ast.append({
-                    "type": "Repeat",
-                    "count": count,
-                    "body": body
-                })
+            
+            # Parse repeat body
+            body, i = parse_block(tokens, i, ('END',))
+            
+            if i < len(tokens) and tokens[i][0] == 'END':
+                i += 1
+            
+            ast.append({
+                "type": "Repeat",
+                "count": count,
+                "body": body
+            })
         
         # For loop
         elif token_type == 'FOR':
@@ -270,19 +310,14 @@ def parse_code(code):
                 var_name = tokens[i][1]
                 i += 1
                 
-                # For-in loop (arrays)
+                # For-in loop (arrays and map keys)
                 if i < len(tokens) and tokens[i][0] == 'IN':
                     i += 1
                     array_name = tokens[i][1]
                     i += 1
                     
                     # Parse body
-                    body = []
-                    while i < len(tokens) and tokens[i][0] != 'END':
-                        stmt_ast = parse_statement(tokens[i:])
-                        if stmt_ast:
-                            body.append(stmt_ast)
-                        i += 1
+                    body, i = parse_block(tokens, i, ('END',))
                     
                     if i < len(tokens) and tokens[i][0] == 'END':
                         i += 1
@@ -294,30 +329,35 @@ def parse_code(code):
                         "body": body
                     })
                 
-                # For-to loop (ranges)
-                elif i < len(tokens) and tokens[i][0] == 'TO':
-                    i += 1
-                    if i < len(tokens) and tokens[i][0] == 'NUMBER':
-                        end_value = int(float(tokens[i][1]))
+                # For-to loop (ranges): 'for i to b' or 'for i from a to b step s'
+                elif i < len(tokens) and (tokens[i][0] == 'TO' or is_word(tokens, i, 'from')):
+                    start = '0'
+                    step = '1'
+                    if tokens[i][0] != 'TO':
+                        start, i = parse_expression(tokens, i + 1)
+                    
+                    if i >= len(tokens) or tokens[i][0] != 'TO':
+                        raise SyntaxError("Expected 'to' in for loop")
+                    end_value, i = parse_expression(tokens, i + 1)
+                    
+                    # 'step = ...' starting the body is an assignment, not a step
+                    if is_word(tokens, i, 'step') and not (i + 1 < len(tokens) and tokens[i+1][1] == '='):
+                        step, i = parse_expression(tokens, i + 1)
+                    
+                    # Parse body
+                    body, i = parse_block(tokens, i, ('END',))
+                    
+                    if i < len(tokens) and tokens[i][0] == 'END':
                         i += 1
-                        
-                        # Parse body
-                        body = []
-                        while i < len(tokens) and tokens[i][0] != 'END':
-                            stmt_ast = parse_statement(tokens[i:])
-                            if stmt_ast:
-                                body.append(stmt_ast)
-                            i += 1
-                        
-                        if i < len(tokens) and tokens[i][0] == 'END':
-                            i += 1
-                        
-                        ast.append({
-                            "type": "ForRange",
-                            "variable": var_name,
-                            "end": end_value,
-                            "body": body
-                        })
+                    
+                    ast.append({
+                        "type": "ForRange",
+                        "variable": var_name,
+                        "start": start,
+                        "end": end_value,
+                        "step": step,
+                        "body": body
+                    })
         
         # Function definition
         elif token_type == 'FUNCTION':
@@ -344,12 +384,7 @@ def parse_code(code):
                     i += 1  # Skip )
                 
                 # Parse function body
-                body = []
-                while i < len(tokens) and tokens[i][0] != 'END':
-                    stmt_ast = parse_statement(tokens[i:])
-                    if stmt_ast:
-                        body.append(stmt_ast)
-                    i += 1
+                body, i = parse_block(tokens, i, ('END',))
                 
                 if i < len(tokens) and tokens[i][0] == 'END':
                     i += 1
@@ -365,78 +400,199 @@ def parse_code(code):
         elif token_type == 'CALL':
             i += 1
             if i < len(tokens) and tokens[i][0] == 'IDENTIFIER':
-                func_name = tokens[i][1]
-                i += 1
-                
-                # Parse arguments
-                args = []
-                if i < len(tokens) and tokens[i][0] == 'LPAREN':
-                    i += 1
-                    
-                    while i < len(tokens) and tokens[i][0] != 'RPAREN':
-                        if tokens[i][0] in ('NUMBER', 'STRING', 'IDENTIFIER', 'BOOLEAN'):
-                            args.append(tokens[i][1])
-                            i += 1
-                            
-                            if i < len(tokens) and tokens[i][0] == 'COMMA':
-                                i += 1
-                        else:
-                            i += 1
-                    
-                    i += 1  # Skip )
-                
-                ast.append({
-                    "type": "Call",
-                    "function": func_name,
-                    "arguments": args
-                })
+                call, i = parse_call(tokens, i)
+                ast.append(call)
         
         # Return statement
         elif token_type == 'RETURN':
             i += 1
             value = None
-            if i < len(tokens) and tokens[i][0] in ('NUMBER', 'STRING', 'IDENTIFIER', 'BOOLEAN'):
-                value = tokens[i][1]
+            if i < len(tokens) and tokens[i][0] in ('NUMBER', 'STRING', 'IDENTIFIER', 'BOOLEAN', 'LPAREN', 'OPERATOR'):
+                value, i = parse_expression(tokens, i)
+            
+            ast.append({"type": "Return", "value": value or None})
+        
+        # Checkpoint statement
+        elif is_word(tokens, i, 'checkpoint'):
+            i += 1
+            path = None
+            if i < len(tokens) and tokens[i][0] == 'STRING':
+                path = tokens[i][1].strip('"')
                 i += 1
             
-            ast.append({"type": "Return", "value": value})
+            ast.append({"type": "Checkpoint", "path": path})
         
         else:
             i += 1
     
-    return ast
+    return ast, i
 
-# Helper to parse a single statement
-def parse_statement(tokens):
-    if not tokens:
-        return None
-    
-    token_type, token_value = tokens[0]
+# Remove a key from a map. Returns nothing, like map_set, because a 'call'
+# statement that produces a value returns from the enclosing block
+def map_delete(args):
+    args[0].pop(args[1], None)
+
+# Built-in functions available to every program
+BUILTINS = {
+    'print': lambda args: print(*args),
+    'len': lambda args: len(args[0]) if args else 0,
+    'random': lambda args: random.random(),
+    'floor': lambda args: math.floor(float(args[0])) if args else 0,
+    'ceil': lambda args: math.ceil(float(args[0])) if args else 0,
+    'sin': lambda args: math.sin(float(args[0])) if args else 0,
+    'cos': lambda args: math.cos(float(args[0])) if args else 0,
+    'map_get': lambda args: args[0].get(args[1], args[2] if len(args) > 2 else None),
+    'map_set': lambda args: args[0].__setitem__(args[1], args[2]),
+    'map_has': lambda args: args[1] in args[0],
+    'map_delete': map_delete,
+    'map_keys': lambda args: list(args[0]),
+}
+
+# Runtime metrics registry; nothing is counted while "enabled" is False
+metrics = {
+    "enabled": False,
+    "statements": {},
+    "user_calls": 0,
+    "builtin_calls": 0,
+    "array_elements": 0,
+    "map_entries": 0,
+    "peak_variables": 0,
+    "runs": 0,
+    "parse_seconds": 0.0,
+    "execute_seconds": 0.0,
+    "hooks": [],
+}
+
+# Turn metrics collection on or off
+def enable_metrics(enabled=True):
+    metrics["enabled"] = enabled
+
+# Zero all counters, keeping the enabled flag and registered hooks
+def reset_metrics():
+    metrics["statements"] = {}
+    for name in ("user_calls", "builtin_calls", "array_elements", "map_entries", "peak_variables", "runs"):
+        metrics[name] = 0
+    metrics["parse_seconds"] = 0.0
+    metrics["execute_seconds"] = 0.0
+
+# Register callback(name, value, label), called on every recorded metric
+def add_metrics_hook(callback):
+    metrics["hooks"].append(callback)
+
+def remove_metrics_hook(callback):
+    metrics["hooks"].remove(callback)
+
+# Add an amount to a counter (or to one label of it) and notify hooks
+def record_metric(name, amount=1, label=None):
+    if label is None:
+        metrics[name] += amount
+        value = metrics[name]
+    else:
+        counts = metrics[name]
+        value = counts[label] = counts.get(label, 0) + amount
+    for hook in metrics["hooks"]:
+        hook(name, value, label)
+
+# Count one executed statement and track the variable table high-water mark
+def record_statement(node, variables):
+    record_metric("statements", 1, node["type"])
+    record_peak_variables(variables)
+
+# Sampled before each statement and when a block finishes, so the table's
+# size after the last statement is seen too
+def record_peak_variables(variables):
+    if len(variables) > metrics["peak_variables"]:
+        metrics["peak_variables"] = len(variables)
+        for hook in metrics["hooks"]:
+            hook("peak_variables", len(variables), None)
+
+# Plain-value copy of the counters, plus Python GC collections per generation
+def metrics_snapshot():
+    snapshot = {name: value for name, value in metrics.items() if name not in ("enabled", "hooks")}
+    snapshot["statements"] = dict(metrics["statements"])
+    snapshot["gc_collections"] = [stats["collections"] for stats in gc.get_stats()]
+    return snapshot
+
+# Render the counters in the Prometheus text exposition format
+def metrics_prometheus():
+    snapshot = metrics_snapshot()
+    lines = ["# TYPE ganga_statements_total counter"]
+    for node_type, count in sorted(snapshot["statements"].items()):
+        lines.append(f'ganga_statements_total{{type="{node_type}"}} {count}')
+    for name, kind in (("user_calls", "counter"), ("builtin_calls", "counter"),
+                       ("array_elements", "counter"), ("map_entries", "counter"),
+                       ("runs", "counter"),
+                       ("parse_seconds", "counter"), ("execute_seconds", "counter"),
+                       ("peak_variables", "gauge")):
+        metric = f"ganga_{name}_total" if kind == "counter" else f"ganga_{name}"
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric} {snapshot[name]}")
+    lines.append("# TYPE ganga_gc_collections_total counter")
+    for generation, count in enumerate(snapshot["gc_collections"]):
+        lines.append(f'ganga_gc_collections_total{{generation="{generation}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+# Write the counters to a file as Prometheus text or JSON
+def export_metrics(path, fmt="prometheus"):
+    if fmt == "prometheus":
+        text = metrics_prometheus()
+    elif fmt == "json":
+        text = json.dumps(metrics_snapshot(), indent=2)
+    else:
+        raise ValueError(f"Unknown metrics format '{fmt}'")
+    with open(path, "w") as f:
+        f.write(text)
+
+# Checkpoint state: the stack of blocks currently executing, the saved
+# frames still to be restored after a resume, and auto-checkpoint settings
+CHECKPOINT_VERSION = 2
+
+checkpoints = {
+    "frames": [],
+    "resume": [],
+    "path": "ganga.ckpt",
+    "interval": 0,
+    "due": 0.0,
+}
+
+# Set the default checkpoint file and the auto-checkpoint interval in seconds
+def configure_checkpoints(path=None, interval=0):
+    if path:
+        checkpoints["path"] = path
+    checkpoints["interval"] = interval
+    checkpoints["due"] = time.monotonic() + interval
+
+# Serialize variables, user functions and every active block's position
+def save_checkpoint(functions, path=None):
+    path = path or checkpoints["path"]
+    frames = []
+    parent_vars = None
+    for frame in checkpoints["frames"]:
+        # Nested blocks share their parent's variables; only function
+        # calls get a table of their own
+        frames.append({
+            "pc": frame["pc"],
+            "loop": frame["loop"],
+            "branch": frame["branch"],
+            "variables": None if frame["variables"] is parent_vars else frame["variables"],
+        })
+        parent_vars = frame["variables"]
     
-    if token_type in ('PRINT', 'INPUT', 'IF', 'WHILE', 'REPEAT', 'FOR', 'FUNCTION', 'CALL', 'RETURN'):
-        if token_type == 'PRINT':
-            if len(tokens) > 1:
-                return {"type": "Print", "value": tokens[1][1]}
-        elif token_type == 'INPUT':
-            prompt = ""
-            var_name = None
-            
-            if len(tokens) > 1 and tokens[1][0] == 'STRING':
-                prompt = tokens[1][1].strip('"')
-                if len(tokens) > 2 and tokens[2][0] == 'IDENTIFIER':
-                    var_name = tokens[2][1]
-            elif len(tokens) > 1 and tokens[1][0] == 'IDENTIFIER':
-                var_name = tokens[1][1]
-                
-            return {"type": "Input", "prompt": prompt, "variable": var_name}
-        elif token_type == 'RETURN':
-            value = None
-            if len(tokens) > 1 and tokens[1][0] in ('NUMBER', 'STRING', 'IDENTIFIER', 'BOOLEAN'):
-                value = tokens[1][1]
-            return {"ok"
-            "nbbtype": "Return", "value": value}
+    state = {
+        "version": CHECKPOINT_VERSION,
+        "ast": checkpoints["frames"][0]["ast"],
+        "functions": {name: func for name, func in functions.items() if not callable(func)},
+        "frames": frames,
+        "path": checkpoints["path"],
+        "interval": checkpoints["interval"],
+    }
     
-    return None
+    # Write then rename so a crash mid-write keeps the previous checkpoint
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    checkpoints["due"] = time.monotonic() + checkpoints["interval"]
 
 # Interpreter: Execute the AST
 def interpret(ast, variables=None, functions=None):
@@ -444,19 +600,38 @@ def interpret(ast, variables=None, functions=None):
         variables = {}
     
     if functions is None:
-        functions = {
-            'print': lambda args: print(*args),
-            'len': lambda args: len(args[0]) if args else 0,
-            'random': lambda args: random.random(),
-            'floor': lambda args: math.floor(float(args[0])) if args else 0,
-            'ceil': lambda args: math.ceil(float(args[0])) if args else 0,
-            'sin': lambda args: math.sin(float(args[0])) if args else 0,
-            'cos': lambda args: math.cos(float(args[0])) if args else 0,
-        }
-    
-    i = 0
+        functions = dict(BUILTINS)
+    
+    # Track this block so a checkpoint can record where execution is
+    frame = {"ast": ast, "variables": variables, "pc": 0, "loop": None, "branch": None}
+    resuming = False
+    if checkpoints["resume"]:
+        saved = checkpoints["resume"].pop(0)
+        frame.update(pc=saved["pc"], loop=saved["loop"], branch=saved["branch"])
+        if saved["variables"] is not None:
+            variables.clear()
+            variables.update(saved["variables"])
+        # Deeper frames remain, so re-enter the statement at pc mid-way
+        resuming = bool(checkpoints["resume"])
+    
+    checkpoints["frames"].append(frame)
+    try:
+        return execute_block(ast, variables, functions, frame, resuming)
+    finally:
+        checkpoints["frames"].pop()
+        if metrics["enabled"]:
+            record_peak_variables(variables)
+
+# Run the statements of one block, starting at the frame's position
+def execute_block(ast, variables, functions, frame, resuming=False):
+    i = frame["pc"]
     while i < len(ast):
         node = ast[i]
+        frame["pc"] = i
+        if metrics["enabled"]:
+            record_statement(node, variables)
+        if checkpoints["interval"] and time.monotonic() >= checkpoints["due"]:
+            save_checkpoint(functions)
         
         # Process return statements
         if node["type"] == "Return":
@@ -503,43 +678,72 @@ def interpret(ast, variables=None, functions=None):
             name = node["name"]
             elements = [get_value(elem, variables) for elem in node["elements"]]
             variables[name] = elements
+            if metrics["enabled"]:
+                record_metric("array_elements", len(elements))
+        
+        # Map assignment
+        elif node["type"] == "AssignMap":
+            entries = {
+                get_value(key, variables): get_value(value, variables)
+                for key, value in node["entries"]
+            }
+            variables[node["name"]] = entries
+            if metrics["enabled"]:
+                record_metric("map_entries", len(entries))
+        
+        # Assignment from a function call
+        elif node["type"] == "AssignCall":
+            args = [get_value(arg, variables) for arg in node["arguments"]]
+            variables[node["name"]] = call_function(node["function"], args, variables, functions)
         
         # If statements
         elif node["type"] == "If":
-            condition = eval_expr(node["condition"], variables)
-            
-            if condition:
-                result = interpret(node["body"], variables, functions)
-                if result is not None:
-                    return result
+            # Pick the branch: "body", an elif index, "else" or None
+            if resuming:
+                branch = frame["branch"]
+            elif eval_expr(node["condition"], variables):
+                branch = "body"
             else:
-                # Check elif clauses
-                elif_executed = False
-                for elif_clause in node["elif_clauses"]:
-                    elif_condition = eval_expr(elif_clause["condition"], variables)
-                    if elif_condition:
-                        result = interpret(elif_clause["body"], variables, functions)
-                        if result is not None:
-                            return result
-                        elif_executed = True
+                # Check elif clauses, then fall back to else
+                branch = "else" if node["else_body"] else None
+                for index, elif_clause in enumerate(node["elif_clauses"]):
+                    if eval_expr(elif_clause["condition"], variables):
+                        branch = index
                         break
+            
+            frame["branch"] = branch
+            if branch is not None:
+                if branch == "body":
+                    body = node["body"]
+                elif branch == "else":
+                    body = node["else_body"]
+                else:
+                    body = node["elif_clauses"][branch]["body"]
                 
-                # Execute else if no if/elif was executed
-                if not elif_executed and node["else_body"]:
-                    result = interpret(node["else_body"], variables, functions)
-                    if result is not None:
-                        return result
+                result = interpret(body, variables, functions)
+                if result is not None:
+                    return result
         
         # Repeat loops
         elif node["type"] == "Repeat":
-            for _ in range(node["count"]):
+            # Loop state is (iteration, total) so a resume keeps the bound
+            # it started with
+            if resuming:
+                start, total = frame["loop"]
+            else:
+                start, total = 0, int(eval_expr(node["count"], variables))
+            
+            for count in range(start, total):
+                frame["loop"] = (count, total)
                 result = interpret(node["body"], variables, functions)
                 if result is not None:
                     return result
         
         # While loops
         elif node["type"] == "While":
-            while eval_expr(node["condition"], variables):
+            # A resumed loop was mid-body, so don't re-check the condition
+            while resuming or eval_expr(node["condition"], variables):
+                resuming = False
                 result = interpret(node["body"], variables, functions)
                 if result is not None:
                     return result
@@ -549,19 +753,41 @@ def interpret(ast, variables=None, functions=None):
             var_name = node["variable"]
             array_name = node["array"]
             
-            if array_name in variables and isinstance(variables[array_name], list):
-                for element in variables[array_name]:
-                    variables[var_name] = element
-                    result = interpret(node["body"], variables, functions)
-                    if result is not None:
-                        return result
+            # Loop state is (index, elements) so a resume walks the same
+            # key snapshot even if the body has changed the map since
+            if resuming:
+                index, elements = frame["loop"]
+            elif array_name in variables and isinstance(variables[array_name], (list, dict)):
+                index, elements = 0, variables[array_name]
+                if isinstance(elements, dict):
+                    # Iterate a snapshot of the keys so the body may modify the map
+                    elements = list(elements)
+            else:
+                index, elements = 0, []
+            
+            while index < len(elements):
+                frame["loop"] = (index, elements)
+                variables[var_name] = elements[index]
+                result = interpret(node["body"], variables, functions)
+                if result is not None:
+                    return result
+                index += 1
         
         # For-range loops
         elif node["type"] == "ForRange":
             var_name = node["variable"]
-            end = node["end"]
             
-            for value in range(end):
+            # Bounds are evaluated once; range() yields values lazily. Loop
+            # state is (value, end, step) so a resume keeps the same bounds
+            if resuming:
+                start, end, step = frame["loop"]
+            else:
+                start = int(eval_expr(node["start"], variables))
+                end = int(eval_expr(node["end"], variables))
+                step = int(eval_expr(node["step"], variables))
+            
+            for value in range(start, end, step):
+                frame["loop"] = (value, end, step)
                 variables[var_name] = value
                 result = interpret(node["body"], variables, functions)
                 if result is not None:
@@ -576,40 +802,51 @@ def interpret(ast, variables=None, functions=None):
         
         # Function calls
         elif node["type"] == "Call":
-            func_name = node["function"]
             args = [get_value(arg, variables) for arg in node["arguments"]]
-            
-            if func_name in functions:
-                func = functions[func_name]
-                
-                if callable(func):
-                    # Built-in function
-                    result = func(args)
-                    if result is not None:
-                        return result
-                else:
-                    # User-defined function
-                    local_vars = variables.copy()
-                    
-                    # Bind parameters to arguments
-                    for i, param in enumerate(func["params"]):
-                        if i < len(args):
-                            local_vars[param] = args[i]
-                        else:
-                            local_vars[param] = None
-                    
-                    # Execute function body
-                    result = interpret(func["body"], local_vars, functions)
-                    if result is not None:
-                        return result
-            else:
-                print(f"Error: Function '{func_name}' not defined")
+            result = call_function(node["function"], args, variables, functions)
+            if result is not None:
+                return result
         
+        # Checkpoint statements
+        elif node["type"] == "Checkpoint":
+            # Resume after this statement, not at it
+            frame["pc"] = i + 1
+            save_checkpoint(functions, node["path"])
+        
+        resuming = False
         i += 1
 
+# Call a builtin or user-defined function with evaluated arguments
+def call_function(func_name, args, variables, functions):
+    if func_name not in functions:
+        print(f"Error: Function '{func_name}' not defined")
+        return None
+    
+    func = functions[func_name]
+    if callable(func):
+        # Built-in function
+        if metrics["enabled"]:
+            record_metric("builtin_calls")
+        return func(args)
+    
+    # User-defined function
+    if metrics["enabled"]:
+        record_metric("user_calls")
+    local_vars = variables.copy()
+    
+    # Bind parameters to arguments
+    for index, param in enumerate(func["params"]):
+        if index < len(args):
+            local_vars[param] = args[index]
+        else:
+            local_vars[param] = None
+    
+    # Execute function body
+    return interpret(func["body"], local_vars, functions)
+
 # Helper to get variable value
 def get_value(val, vars):
-    if isinstance(val, (int, float, bool, list)):
+    if isinstance(val, (int, float, bool, list, dict)):
         return val
     elif val in vars:
         return vars[val]
@@ -617,8 +854,9 @@ def get_value(val, vars):
         return float(val) if '.' in val else int(val)
     elif val.lower() in ('true', 'false'):
         return val.lower() == 'true'
-    elif val.startswith('"') and val.endswith('"'):
-        return val.strip('"')
+    elif val.startswith('"') and val.endswith('"') and val.count('"') == 2:
+        # A single string token; '"a" + "b"' is evaluated below
+        return val[1:-1]
     else:
         # Try evaluating as expression
         try:
@@ -626,32 +864,235 @@ def get_value(val, vars):
         except:
             return val
 
-# Evaluate expressions with variables
+# Names every expression can use besides the program's variables
+EXPR_GLOBALS = {"__builtins__": {}, "true": True, "false": False}
+
+# Python keywords that are ordinary names in Ganga (e.g. 'from'), matched
+# outside string literals
+PYTHON_KEYWORD_NAMES = re.compile(r'"[^"]*"|\b(' + '|'.join(
+    word for word in keyword.kwlist if word not in ('and', 'or', 'not', 'True', 'False', 'None')
+) + r')\b')
+
+# Evaluate expressions with variables. Variables are looked up by name, so
+# strings, booleans and maps keep their types; errors propagate to the caller
 def eval_expr(expr, vars):
-    # Replace variables with their values
-    for name, val in vars.items():
-        if not isinstance(val, list):
-            pattern = r'\b' + re.escape(name) + r'\b'
-            expr = re.sub(pattern, str(val).lower() if isinstance(val, bool) else str(val), expr)
-    
-    # Replace logical operators for Python evaluation
-    expr = expr.replace('and', ' and ').replace('or', ' or ').replace('not', ' not ')
+    if PYTHON_KEYWORD_NAMES.search(expr):
+        # Rename variables Python can't parse, e.g. 'from' -> '_ganga_from'
+        namespace = dict(vars)
+        
+        def rename(match):
+            word = match.group(1)
+            if word is None or word not in vars:
+                return match.group()
+            namespace['_ganga_' + word] = vars[word]
+            return '_ganga_' + word
+        
+        expr = PYTHON_KEYWORD_NAMES.sub(rename, expr)
+        return eval(expr, EXPR_GLOBALS, namespace)
     
-    try:
-        return eval(expr)
-    except:
-        return expr
+    return eval(expr, EXPR_GLOBALS, vars)
 
 # Main function
 def run_program(code):
     try:
+        if not metrics["enabled"]:
+            interpret(parse_code(code))
+            return
+        
+        start = time.perf_counter()
         ast = parse_code(code)
-        interpret(ast)
+        parsed = time.perf_counter()
+        try:
+            interpret(ast)
+        finally:
+            record_metric("parse_seconds", parsed - start)
+            record_metric("execute_seconds", time.perf_counter() - parsed)
+            record_metric("runs")
     except Exception as e:
         print(f"Error: {e}")
 
+# Continue a program from a checkpoint file written by save_checkpoint. The
+# job keeps checkpointing to the same file at the same interval unless
+# checkpoint_path or interval override them
+def resume_program(path, checkpoint_path=None, interval=None):
+    try:
+        with gzip.open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version in '{path}'")
+        
+        configure_checkpoints(
+            checkpoint_path or state.get("path") or path,
+            state.get("interval", 0) if interval is None else interval
+        )
+        
+        functions = dict(BUILTINS)
+        functions.update(state["functions"])
+        checkpoints["resume"] = state["frames"]
+        interpret(state["ast"], {}, functions)
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        checkpoints["resume"] = []
+
+# Statements that open a block closed by 'end'
+BLOCK_OPENERS = ('IF', 'WHILE', 'REPEAT', 'FOR', 'FUNCTION', 'TRY')
+
+# Count how many blocks in the code are still waiting for their 'end'
+def block_depth(code):
+    depth = 0
+    for token_type, _ in tokenize(code):
+        if token_type in BLOCK_OPENERS:
+            depth += 1
+        elif token_type == 'END':
+            depth -= 1
+    return depth
+
+REPL_HELP = """Commands:
+  :help           Show this help
+  :vars           List variables
+  :funcs          List user-defined functions
+  :load <file>    Run a Ganga file in this session
+  :time <stmt>    Run a statement and report parse/execute time
+  :mem <stmt>     Run a statement and report peak memory allocated
+  :metrics [on|off|reset]
+                  Toggle metrics collection or print the counters
+  :reset          Clear all variables and functions
+  :quit           Leave the REPL"""
+
+# Parse and run a piece of code against the session state. Ctrl-C stops
+# the running code but keeps the session
+def repl_execute(code, variables, functions):
+    try:
+        ast = parse_code(code)
+        result = interpret(ast, variables, functions)
+        if result is not None:
+            print(result)
+    except KeyboardInterrupt:
+        print("Interrupted")
+    except Exception as e:
+        print(f"Error: {e}")
+
+# Handle a ':' command; returns False when the REPL should exit
+def repl_command(line, variables, functions):
+    command, _, arg = line.partition(' ')
+    arg = arg.strip()
+    
+    if command in (':quit', ':exit', ':q'):
+        return False
+    elif command == ':help':
+        print(REPL_HELP)
+    elif command == ':vars':
+        for name, value in variables.items():
+            print(f"{name} = {value!r}")
+    elif command == ':funcs':
+        for name, func in functions.items():
+            if not callable(func):
+                print(f"{name}({', '.join(func['params'])})")
+    elif command == ':metrics':
+        if arg in ('on', 'off'):
+            enable_metrics(arg == 'on')
+        elif arg == 'reset':
+            reset_metrics()
+        else:
+            print(metrics_prometheus(), end='')
+    elif command == ':reset':
+        variables.clear()
+        functions.clear()
+        functions.update(BUILTINS)
+    elif command == ':load':
+        try:
+            with open(arg) as f:
+                repl_execute(f.read(), variables, functions)
+        except OSError as e:
+            print(f"Error: {e}")
+    elif command == ':time':
+        try:
+            start = time.perf_counter()
+            ast = parse_code(arg)
+            parsed = time.perf_counter()
+            result = interpret(ast, variables, functions)
+            done = time.perf_counter()
+            if result is not None:
+                print(result)
+            print(f"parse {(parsed - start) * 1000:.3f} ms, "
+                  f"execute {(done - parsed) * 1000:.3f} ms")
+        except KeyboardInterrupt:
+            print("Interrupted")
+        except Exception as e:
+            print(f"Error: {e}")
+    elif command == ':mem':
+        tracemalloc.start()
+        try:
+            repl_execute(arg, variables, functions)
+            current, peak = tracemalloc.get_traced_memory()
+            print(f"current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB")
+        finally:
+            tracemalloc.stop()
+    else:
+        print(f"Unknown command '{command}', type :help")
+    return True
+
+# Interactive loop: variables and functions persist between inputs and
+# only the newly entered code is parsed
+def repl(variables=None, functions=None):
+    if variables is None:
+        variables = {}
+    if functions is None:
+        functions = dict(BUILTINS)
+    
+    print("Ganga REPL - type :help for commands")
+    buffer = []
+    while True:
+        try:
+            line = input("... " if buffer else ">>> ")
+        except EOFError:
+            print()
+            break
+        except KeyboardInterrupt:
+            print()
+            buffer = []
+            continue
+        
+        if not buffer and line.strip().startswith(':'):
+            if not repl_command(line.strip(), variables, functions):
+                break
+            continue
+        
+        # Keep reading until every block is closed with 'end'
+        buffer.append(line)
+        code = '\n'.join(buffer)
+        if block_depth(code) > 0:
+            continue
+        buffer = []
+        repl_execute(code, variables, functions)
+
 # Example usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Ganga programs")
+    parser.add_argument("file", nargs="?", help="Ganga program to run (runs the demo if omitted)")
+    parser.add_argument("--repl", action="store_true", help="start the interactive REPL")
+    parser.add_argument("--resume", metavar="CHECKPOINT", help="continue from a checkpoint file")
+    parser.add_argument("--checkpoint-file", metavar="PATH",
+                        help="file written by checkpoint statements (default: ganga.ckpt, "
+                             "or the resumed file's setting)")
+    parser.add_argument("--checkpoint-every", metavar="SECONDS", type=float,
+                        help="also checkpoint automatically at this interval "
+                             "(a resumed job keeps its own unless given)")
+    options = parser.parse_args()
+    configure_checkpoints(options.checkpoint_file, options.checkpoint_every or 0)
+    
+    if options.repl:
+        repl()
+        sys.exit()
+    if options.resume:
+        resume_program(options.resume, options.checkpoint_file, options.checkpoint_every)
+        sys.exit()
+    if options.file:
+        with open(options.file) as f:
+            run_program(f.read())
+        sys.exit()
+    
     code = '''
     # Example program in our language
     